@@ -64,6 +64,10 @@ datafile_iter = iter(datafile)  # initialize dataset iterator
 
 # Initialize object detection
 configs_det = det.load_configs(model_name='fpn_resnet')  # options are 'darknet', 'fpn_resnet'
+
+# Uncomment this setting to calibrate the int8 model used on the cpu with stored birds-eye views (only needed once)
+# configs_det.calib_bev_maps = [load_object_from_file(results_fullpath, data_filename, 'lidar_bev', cnt)
+#                               for cnt in range(show_only_frames[0], show_only_frames[0] + 8)]
 model_det = det.create_model(configs_det)
 
 configs_det.use_labels_as_objects = False  # True = use groundtruth labels as objects, False = use model-based detection
@@ -11,26 +11,50 @@
 #
 
 # general package imports
+from types import SimpleNamespace
+from typing import List
+
 import numpy as np
 import torch
 from easydict import EasyDict as edict
 
+# numba is optional, it is used to speed up decoding on the cpu
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
 # add project directory to python path to enable relative imports
 import os
 import sys
 
-from tools.objdet_models.resnet.utils.torch_utils import _sigmoid
+from tools.objdet_models.resnet.utils.torch_utils import _fused_sigmoid
 
 PACKAGE_PARENT = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
-# model-related
-from tools.objdet_models.resnet.models import fpn_resnet
-from tools.objdet_models.resnet.utils.evaluation_utils import decode, post_processing
+# model directories relative to the project directory
+_CURR_DIR = os.path.dirname(os.path.realpath(__file__))
+_PARENT_DIR = os.path.abspath(os.path.join(_CURR_DIR, os.pardir))
+_DARKNET_DIR = os.path.join(_PARENT_DIR, 'tools', 'objdet_models', 'darknet')
+_RESNET_DIR = os.path.join(_PARENT_DIR, 'tools', 'objdet_models', 'resnet')
+
+# devices shared by all configs, gpus are keyed by their index
+_CPU = torch.device('cpu')
+_GPU = {}
+
+
+def _get_device(no_cuda, gpu_idx):
+    """"
+    Return the shared cpu device, or the shared device of the gpu with the given index
+    """
 
-from tools.objdet_models.darknet.models.darknet2pytorch import Darknet as darknet
-from tools.objdet_models.darknet.utils.evaluation_utils import post_processing_v2
+    if no_cuda:
+        return _CPU
+    if gpu_idx not in _GPU:
+        _GPU[gpu_idx] = torch.device('cuda:{}'.format(gpu_idx))
+    return _GPU[gpu_idx]
 
 
 def load_configs_model(model_name='darknet', configs=None):
@@ -50,13 +74,9 @@ def load_configs_model(model_name='darknet', configs=None):
     if configs == None:
         configs = edict()
 
-    # get parent directory of this file to enable relative paths
-    curr_path = os.path.dirname(os.path.realpath(__file__))
-    parent_path = configs.model_path = os.path.abspath(os.path.join(curr_path, os.pardir))
-
     # set parameters according to model type
     if model_name == "darknet":
-        configs.model_path = os.path.join(parent_path, 'tools', 'objdet_models', 'darknet')
+        configs.model_path = _DARKNET_DIR
         configs.pretrained_filename = os.path.join(configs.model_path, 'pretrained', 'complex_yolov4_mse_loss.pth')
         configs.arch = 'darknet'
         configs.batch_size = 4
@@ -71,7 +91,7 @@ def load_configs_model(model_name='darknet', configs=None):
         configs.use_giou_loss = False
 
     elif model_name == 'fpn_resnet':
-        configs.model_path = os.path.join(parent_path, 'tools', 'objdet_models', 'resnet')
+        configs.model_path = _RESNET_DIR
         configs.pretrained_filename = configs.pretrained_path \
             = os.path.join(configs.model_path, 'pretrained', 'fpn_resnet_18_epoch_300.pth')
         configs.arch = 'fpn_resnet'
@@ -115,7 +135,14 @@ def load_configs_model(model_name='darknet', configs=None):
     # GPU vs. CPU
     configs.no_cuda = True  # if true, cuda is not used
     configs.gpu_idx = 0  # GPU index to use.
-    configs.device = torch.device('cpu' if configs.no_cuda else 'cuda:{}'.format(configs.gpu_idx))
+    configs.device = _get_device(configs.no_cuda, configs.gpu_idx)
+    configs.use_cuda_graphs = True  # if true, fpn_resnet inference and decoding run as a cuda graph on the gpu
+    configs.use_tensorrt = True  # if true, the model is compiled with Torch-TensorRT when running on the gpu
+    configs.use_jit = True  # if true, the model is traced and frozen with torchscript unless compiled with TensorRT
+    configs.use_int8 = True  # if true, the backbone is quantized to int8 when running on the cpu, see quantize_model
+    configs.calib_bev_maps = []  # bev maps used to calibrate the int8 backbone
+    configs.use_numba = True  # if true, the fpn_resnet output is decoded with numba when running on the cpu
+    configs.use_ipex = True  # if true, the float model is optimized with Intel Extension for PyTorch on the cpu
 
     return configs
 
@@ -143,6 +170,7 @@ def load_configs(model_name='fpn_resnet', configs=None):
     configs.lim_r = [0, 1.0]  # reflected lidar intensity
     configs.bev_width = 608  # pixel resolution of bev image
     configs.bev_height = 608
+    set_bev_scales(configs)
 
     # add model-dependent parameters
     configs = load_configs_model(model_name, configs)
@@ -154,6 +182,37 @@ def load_configs(model_name='fpn_resnet', configs=None):
     return configs
 
 
+def set_bev_scales(configs):
+    """"
+    Precompute the factors converting BEV pixels into metres, detect_objects calls this again whenever the bev limits
+    or resolution have changed
+
+    Parameters:
+    configs (edict): dictionary containing the bev parameters
+
+    Returns:
+    configs (edict): dictionary with updated parameters configured
+    """
+
+    configs.range_x = configs.lim_x[1] - configs.lim_x[0]
+    configs.range_y = configs.lim_y[1] - configs.lim_y[0]
+    configs.sx = configs.range_x / configs.bev_height  # metres per bev pixel in x
+    configs.sy = configs.range_y / configs.bev_width  # metres per bev pixel in y
+    configs.half_y = configs.range_y * 0.5
+    configs.bev_scales_key = _bev_scales_key(configs)
+
+    return configs
+
+
+def _bev_scales_key(configs):
+    """"
+    Return the bev limits and resolution the scale factors set by set_bev_scales are derived from
+    """
+
+    return (configs.lim_x[0], configs.lim_x[1], configs.lim_y[0], configs.lim_y[1],
+            configs.bev_width, configs.bev_height)
+
+
 def create_model(configs):
     """"
     Create model according to selected model type
@@ -168,100 +227,683 @@ def create_model(configs):
     # check for availability of model file
     assert os.path.isfile(configs.pretrained_filename), "No file at {}".format(configs.pretrained_filename)
 
-    # create model depending on architecture name
+    # create model depending on architecture name, only the selected architecture is imported
+    # and its post-processing function is kept in the configs structure for detect_objects
     if (configs.arch == 'darknet') and (configs.cfgfile is not None):
         print('using darknet')
+        from tools.objdet_models.darknet.models.darknet2pytorch import Darknet as darknet
+        from tools.objdet_models.darknet.utils.evaluation_utils import post_processing_v2
         model = darknet(cfgfile=configs.cfgfile, use_giou_loss=configs.use_giou_loss)
+        configs.post_processing = post_processing_v2
 
     elif 'fpn_resnet' in configs.arch:
         print('using ResNet architecture with feature pyramid')
+        from tools.objdet_models.resnet.models import fpn_resnet
+        from tools.objdet_models.resnet.utils.evaluation_utils import decode
         model = fpn_resnet.get_pose_net(num_layers=configs.num_layers, heads=configs.heads,
                                         head_conv=configs.head_conv, imagenet_pretrained=configs.imagenet_pretrained)
+        configs.decode = decode
 
     else:
         assert False, 'Undefined model backbone'
 
     # load model weights
-    model.load_state_dict(torch.load(configs.pretrained_filename, map_location='cpu'))
+    model.load_state_dict(load_weights(configs))
     print('Loaded weights from {}\n'.format(configs.pretrained_filename))
 
-    # set model to evaluation state
-    configs.device = torch.device('cpu' if configs.no_cuda else 'cuda:{}'.format(configs.gpu_idx))
+    # allow tensor-float32 matmuls on gpus with tensor cores
+    torch.set_float32_matmul_precision('high')
+
+    # set model to evaluation state, the device is looked up again in case configs.no_cuda has been changed
+    configs.device = _get_device(configs.no_cuda, configs.gpu_idx)
     model = model.to(device=configs.device)  # load model to either cpu or gpu
+    model = model.to(memory_format=torch.channels_last)  # convolutions are faster on channels-last tensors
     model.eval()
 
+    # buffers and cuda graphs reused by detect_objects, keyed by shape, they are kept in a namespace
+    # because the edict would turn plain dicts into edicts, which only accept string keys
+    configs.cache = SimpleNamespace(pinned_buffers={}, cuda_graphs={})
+
+    # quantize the backbone to int8 when running on the cpu, otherwise (also if there is nothing to quantize
+    # the backbone with) use oneDNN-optimized kernels from Intel Extension for PyTorch
+    is_quantized = False
+    if configs.device.type == 'cpu' and configs.use_int8:
+        model, is_quantized = quantize_model(model, configs)
+    if configs.device.type == 'cpu' and configs.use_ipex and not is_quantized:
+        try:
+            import intel_extension_for_pytorch as ipex
+            model = ipex.optimize(model)
+        except ImportError:
+            print('Intel Extension for PyTorch not available, using default cpu kernels\n')
+
+    # compile model into a TensorRT engine when running on the gpu, otherwise trace and freeze it with torchscript
+    use_tensorrt = configs.device.type == 'cuda' and configs.use_tensorrt
+    model_trt = compile_tensorrt(model, configs) if use_tensorrt else None
+    if model_trt is not None:
+        model = model_trt
+    elif configs.use_jit:
+        model = trace_model(model, configs)
+
+    return model
+
+
+def load_weights(configs):
+    """"
+    Load the pretrained weights, which are converted once into a zipfile checkpoint that can be memory-mapped
+
+    Parameters:
+    configs (edict): dictionary containing object and model-related parameters
+
+    Returns:
+    state_dict (dict): model weights on the cpu
+    """
+
+    # reuse the converted checkpoint as long as it is newer than the pretrained file
+    mmap_filename = os.path.splitext(configs.pretrained_filename)[0] + '_mmap.pth'
+    if os.path.isfile(mmap_filename) and \
+            os.path.getmtime(mmap_filename) >= os.path.getmtime(configs.pretrained_filename):
+        return torch.load(mmap_filename, map_location='cpu', mmap=True, weights_only=True)
+
+    state_dict = torch.load(configs.pretrained_filename, map_location='cpu')
+    torch.save(state_dict, mmap_filename, _use_new_zipfile_serialization=True)
+    print('Saved memory-mappable weights to {}'.format(mmap_filename))
+
+    return state_dict
+
+
+def quantize_model(model, configs):
+    """"
+    Quantize the convolutional backbone to int8 using post-training static quantization and cache the result
+    next to the pretrained weights
+    Ref https://pytorch.org/docs/stable/quantization.html#prototype-fx-graph-mode-quantization
+
+    Parameters:
+    model (): pytorch version of darknet or resnet in evaluation state on the cpu
+    configs (edict): dictionary containing object and model-related parameters, the bev maps in
+                     configs.calib_bev_maps are used for calibration if no cached model exists
+
+    Returns:
+    model (): model with quantized backbone, or the unchanged model if there are neither cached int8 weights
+              nor calibration data
+    is_quantized (bool): true if the backbone has been quantized
+    """
+
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    # reuse the quantized weights as long as they are newer than the pretrained file
+    int8_filename = os.path.splitext(configs.pretrained_filename)[0] + '_int8.pth'
+    use_cache = os.path.isfile(int8_filename) and \
+        os.path.getmtime(int8_filename) >= os.path.getmtime(configs.pretrained_filename)
+    if not use_cache and len(configs.calib_bev_maps) == 0:
+        print('No calibration data in configs.calib_bev_maps, using float model\n')
+        return model, False
+
+    # quantize the submodules which are free of shape-dependent control flow and can therefore be traced by fx,
+    # each of them quantizes its input and dequantizes its output
+    if 'fpn_resnet' in configs.arch:
+        names = ['layer1', 'layer2', 'layer3', 'layer4']
+    else:
+        names = ['models.{}'.format(i) for i, block in enumerate(model.models)
+                 if any(isinstance(layer, torch.nn.Conv2d) for layer in block.modules())]
+
+    # record an example input of every submodule
+    example_inputs = {}
+    hooks = [model.get_submodule(name).register_forward_pre_hook(
+        lambda module, inputs, name=name: example_inputs.setdefault(name, inputs)) for name in names]
+    with torch.no_grad():
+        model(_example_bev_maps(configs))
+    for hook in hooks:
+        hook.remove()
+
+    # insert observers and collect activation statistics on the calibration data
+    qconfig_mapping = get_default_qconfig_mapping('x86')
+    for name in names:
+        _set_submodule(model, name, prepare_fx(model.get_submodule(name), qconfig_mapping, example_inputs[name]))
+    if not use_cache:
+        with torch.no_grad():
+            for bev_maps in configs.calib_bev_maps:
+                model(bev_maps.contiguous(memory_format=torch.channels_last))
+
+    for name in names:
+        _set_submodule(model, name, convert_fx(model.get_submodule(name)))
+
+    # quantized modules can not be pickled, so only their weights and quantization parameters are stored
+    if use_cache:
+        model.load_state_dict(torch.load(int8_filename, map_location='cpu'))
+        print('Loaded int8 weights from {}\n'.format(int8_filename))
+    else:
+        torch.save(model.state_dict(), int8_filename)
+        print('Saved int8 weights to {}\n'.format(int8_filename))
+
+    return model, True
+
+
+def _set_submodule(model, name, module):
+    """"
+    Replace the submodule with the given dotted name
+    """
+
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name), child_name, module)
+
+
+class TupleOutputs(torch.nn.Module):
+    """
+    Wrap a model returning a dict of heads so that it returns a tuple ordered like the heads, as needed for tracing
+    """
+
+    def __init__(self, model, heads):
+        super(TupleOutputs, self).__init__()
+        self.model = model
+        self.heads = list(heads)
+
+    def forward(self, x):
+        outputs = self.model(x)
+        return tuple(outputs[head] for head in self.heads)
+
+
+def _autocast(configs):
+    """"
+    Create the autocast context used for the forward pass (bfloat16 on the gpu, disabled on the cpu)
+    """
+
+    # the weight cast cache has to be disabled for cuda graph capture
+    return torch.autocast(device_type=configs.device.type, dtype=torch.bfloat16,
+                          enabled=(configs.device.type == 'cuda'), cache_enabled=False)
+
+
+def _example_bev_maps(configs, batch_size=1):
+    """"
+    Create an all-zero input tensor with the shape of the bev maps produced by bev_from_pcl
+
+    Parameters:
+    configs (edict): dictionary containing object and model-related parameters
+    batch_size (int): number of bev maps in the batch
+
+    Returns:
+    input_bev_maps (tensor): example input in the format expected by the model
+    """
+
+    # bev maps consist of an intensity, a height and a density layer
+    return torch.zeros(batch_size, 3, configs.bev_height, configs.bev_width, device=configs.device)
+
+
+def compile_tensorrt(model, configs):
+    """"
+    Compile model into a TensorRT engine and cache the engine next to the pretrained weights
+    Ref https://pytorch.org/TensorRT/getting_started/quick_start_guide.html
+
+    Parameters:
+    model (): pytorch version of darknet or resnet
+    configs (edict): dictionary containing object and model-related parameters
+
+    Returns:
+    model (): compiled model, or None if Torch-TensorRT is not installed or the model can not be compiled
+    """
+
+    try:
+        import torch_tensorrt
+    except ImportError:
+        print('Torch-TensorRT not available\n')
+        return None
+
+    # engines are only valid for the architecture and input shapes they have been built for,
+    # single bev maps as well as full batches are supported
+    min_shape = _example_bev_maps(configs).shape
+    max_shape = (configs.batch_size,) + min_shape[1:]
+    trt_inputs = [torch_tensorrt.Input(min_shape=min_shape, opt_shape=min_shape, max_shape=max_shape,
+                                       dtype=torch.float32)]
+    engine_filename = os.path.join(os.path.dirname(configs.pretrained_filename), '{}_trt_{}.ep'.format(
+        configs.arch, 'x'.join(str(s) for s in max_shape)))
+
+    # reuse the engine as long as it is newer than the pretrained file and still accepts all batch sizes
+    if os.path.isfile(engine_filename) and \
+            os.path.getmtime(engine_filename) >= os.path.getmtime(configs.pretrained_filename):
+        try:
+            model_trt = _check_batch_sizes(torch_tensorrt.load(engine_filename).module(), configs)
+            print('Loaded TensorRT engine from {}\n'.format(engine_filename))
+            return model_trt
+        except Exception as err:
+            print('Could not use TensorRT engine {}, rebuilding it: {}\n'.format(engine_filename, err))
+
+    # models which can not be compiled, e.g. because their forward pass copies to the host, are traced instead
+    try:
+        model_trt = torch_tensorrt.compile(model, ir='dynamo', inputs=trt_inputs, enabled_precisions={torch.float16})
+    except Exception as err:
+        print('Could not compile {} model with Torch-TensorRT: {}\n'.format(configs.arch, err))
+        return None
+
+    # the saved engine is only kept if it can be loaded and still accepts all batch sizes after loading
+    try:
+        example_input = _example_bev_maps(configs).contiguous(memory_format=torch.channels_last)
+        torch_tensorrt.save(model_trt, engine_filename, arg_inputs=[example_input])
+        _check_batch_sizes(torch_tensorrt.load(engine_filename).module(), configs)
+        print('Saved TensorRT engine to {}\n'.format(engine_filename))
+    except Exception as err:
+        if os.path.isfile(engine_filename):
+            os.remove(engine_filename)
+        print('Could not save TensorRT engine to {}, it is compiled again next time: {}\n'.format(
+            engine_filename, err))
+
+    return model_trt
+
+
+def _check_batch_sizes(model, configs):
+    """"
+    Run model on a single bev map and on a full batch, raising an error if either batch size is not supported
+    """
+
+    with torch.no_grad():
+        for batch_size in sorted({1, configs.batch_size}):
+            model(_example_bev_maps(configs, batch_size).contiguous(memory_format=torch.channels_last))
+
+    return model
+
+
+def trace_model(model, configs):
+    """"
+    Trace model with torchscript and freeze it to remove python overhead from the forward pass
+    Ref https://pytorch.org/docs/stable/generated/torch.jit.freeze.html
+
+    Parameters:
+    model (): pytorch version of darknet or resnet
+    configs (edict): dictionary containing object and model-related parameters
+
+    Returns:
+    model (): frozen torchscript module, fpn_resnet heads are returned as a tuple ordered like configs.heads
+    """
+
+    # tracing only supports tensors and tuples of tensors as outputs
+    if 'fpn_resnet' in configs.arch:
+        model = TupleOutputs(model, configs.heads).eval()
+
+    example_input = _example_bev_maps(configs).contiguous(memory_format=torch.channels_last)
+    with torch.no_grad(), _autocast(configs):
+        model = torch.jit.trace(model, example_input, strict=False, check_trace=False)
+    model = torch.jit.freeze(model)
+    print('Traced and froze {} model\n'.format(configs.arch))
+
     return model
 
 
+@torch.jit.script
+def _project_detections(detections, class_id: int, conf_thresh: float, down_ratio: float, sx: float, sy: float,
+                        half_y: float, lim_x: List[float], lim_y: List[float], lim_z: List[float]):
+    """"
+    Perform the post-processing of decoded fpn_resnet detections and convert them from BEV into vehicle space
+
+    Parameters:
+    detections (tensor): decoded detections [batch_size, K, 10], see decode
+    class_id (int): class of the objects to keep
+    conf_thresh (float): minimum score of the objects to keep
+    down_ratio (float), sx (float), sy (float), half_y (float): scale factors set in the configs structure
+    lim_x (list), lim_y (list), lim_z (list): detection range
+
+    Returns:
+    objects (tensor): all detections [batch_size * K, 9] as [sample index, id, x, y, z, height, width, length, yaw]
+    keep (tensor): mask of the objects of class_id with a score above conf_thresh inside the detection range
+    """
+
+    batch_size, num_objects, _ = detections.shape
+    detections = detections.reshape(batch_size * num_objects, -1)
+    sample_idx = torch.arange(batch_size, device=detections.device).repeat_interleave(num_objects)
+
+    # width and length are predicted in metres, so the pixel scaling of post_processing cancels out here
+    img_x = detections[:, 2] * down_ratio * sx
+    img_y = detections[:, 1] * down_ratio * sy - half_y
+    z = detections[:, 3]
+    yaw = torch.atan2(detections[:, 7], detections[:, 8])
+    objects = torch.stack([sample_idx.to(detections.dtype), torch.ones_like(z), img_x, img_y, z,
+                           detections[:, 4], detections[:, 5], detections[:, 6], yaw], dim=1)
+
+    keep = (detections[:, 9] == class_id) & (detections[:, 0] > conf_thresh) \
+        & (img_x >= lim_x[0]) & (img_x <= lim_x[1]) \
+        & (img_y >= lim_y[0]) & (img_y <= lim_y[1]) \
+        & (z >= lim_z[0]) & (z <= lim_z[1])
+
+    return objects, keep
+
+
+def _decode_numba(hm_cen, cen_offset, direction, z_coor, dim, k, class_id, conf_thresh, down_ratio, sx, sy, half_y,
+                  x_min, x_max, y_min, y_max, z_min, z_max):
+    """"
+    Same as decode followed by _project_detections for fpn_resnet outputs in numpy arrays, compiled with numba
+
+    Returns:
+    objects (2D numpy array): all detections [batch_size * k, 9], see _project_detections
+    keep (1D numpy array): mask of the objects to keep, see _project_detections
+    """
+
+    batch_size, num_classes, height, width = hm_cen.shape
+    num_cells = height * width
+    objects = np.zeros((batch_size * k, 9), dtype=np.float32)
+    keep = np.zeros(batch_size * k, dtype=np.bool_)
+
+    for b in prange(batch_size):
+        # sigmoid of the heatmap (clamped like _sigmoid) followed by 3x3 max-pooling nms
+        heat = np.empty((num_classes, height, width), dtype=np.float32)
+        for c in range(num_classes):
+            for y in range(height):
+                for x in range(width):
+                    heat[c, y, x] = min(max(1.0 / (1.0 + np.exp(-hm_cen[b, c, y, x])), 1e-4), 1.0 - 1e-4)
+        peaks = np.empty(num_classes * num_cells, dtype=np.float32)
+        for c in range(num_classes):
+            for y in range(height):
+                for x in range(width):
+                    value = heat[c, y, x]
+                    is_peak = True
+                    for ny in range(max(y - 1, 0), min(y + 2, height)):
+                        for nx in range(max(x - 1, 0), min(x + 2, width)):
+                            if heat[c, ny, nx] > value:
+                                is_peak = False
+                    peaks[c * num_cells + y * width + x] = value if is_peak else 0.0
+
+        # top-k peaks over all classes, in descending order of their score
+        top_inds = np.argsort(-peaks, kind='mergesort')[:k]
+        for i in range(k):
+            ind = top_inds[i]
+            cls = ind // num_cells
+            y = (ind % num_cells) // width
+            x = ind % width
+
+            offset_x = min(max(1.0 / (1.0 + np.exp(-cen_offset[b, 0, y, x])), 1e-4), 1.0 - 1e-4)
+            offset_y = min(max(1.0 / (1.0 + np.exp(-cen_offset[b, 1, y, x])), 1e-4), 1.0 - 1e-4)
+            img_x = (y + offset_y) * down_ratio * sx
+            img_y = (x + offset_x) * down_ratio * sy - half_y
+            z = z_coor[b, 0, y, x]
+
+            row = b * k + i
+            objects[row, 0] = b
+            objects[row, 1] = 1.0
+            objects[row, 2] = img_x
+            objects[row, 3] = img_y
+            objects[row, 4] = z
+            objects[row, 5] = dim[b, 0, y, x]
+            objects[row, 6] = dim[b, 1, y, x]
+            objects[row, 7] = dim[b, 2, y, x]
+            objects[row, 8] = np.arctan2(direction[b, 0, y, x], direction[b, 1, y, x])
+            keep[row] = (cls == class_id and peaks[ind] > conf_thresh
+                         and x_min <= img_x <= x_max and y_min <= img_y <= y_max and z_min <= z <= z_max)
+
+    return objects, keep
+
+
+_decode_numba = njit(cache=True, parallel=True, fastmath=True)(_decode_numba) if njit is not None else None
+
+
+def _decode_outputs(outputs, configs):
+    """"
+    Apply sigmoid to the heatmap and center offset heads, decode the top-k detections of fpn_resnet
+    and convert them into vehicle space, see _project_detections
+
+    Returns:
+    objects (tensor), keep (tensor): see _project_detections, or None if no object can reach configs.conf_thresh
+    """
+
+    # skip decoding if even the highest heatmap peak is below the score threshold, this synchronizes with
+    # the device and is therefore left out of cuda graphs
+    if configs.device.type != 'cuda' or not torch.cuda.is_current_stream_capturing():
+        max_score = torch.clamp(outputs['hm_cen'].amax().sigmoid(), min=1e-4, max=1 - 1e-4)
+        if max_score.item() <= configs.conf_thresh:
+            return None
+
+    # vehicles (class 1) are the only objects passed on to tracking
+    if configs.device.type == 'cpu' and configs.use_numba and _decode_numba is not None:
+        objects, keep = _decode_numba(*[np.ascontiguousarray(outputs[head].numpy()) for head in
+                                        ('hm_cen', 'cen_offset', 'direction', 'z_coor', 'dim')],
+                                      configs.k, 1, float(configs.conf_thresh), float(configs.down_ratio),
+                                      configs.sx, configs.sy, configs.half_y, *configs.lim_x, *configs.lim_y,
+                                      *configs.lim_z)
+        return torch.from_numpy(objects), torch.from_numpy(keep)
+
+    outputs['hm_cen'], outputs['cen_offset'] = _fused_sigmoid(outputs['hm_cen'], outputs['cen_offset'])
+    detections = configs.decode(outputs['hm_cen'], outputs['cen_offset'],
+                                outputs['direction'], outputs['z_coor'], outputs['dim'], K=configs.k)
+    return _project_detections(detections, 1, float(configs.conf_thresh), float(configs.down_ratio),
+                               configs.sx, configs.sy, configs.half_y, [float(v) for v in configs.lim_x],
+                               [float(v) for v in configs.lim_y], [float(v) for v in configs.lim_z])
+
+
+def _capture_cuda_graph(fn, static_inputs, num_warmup=3):
+    """"
+    Capture fn(static_inputs) into a cuda graph
+    Ref https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+
+    Parameters:
+    fn (function): function to capture, must only use static shapes and no host synchronization
+    static_inputs (): tensors which have to be overwritten in-place before each replay
+    num_warmup (int): number of eager iterations on a side stream before capture
+
+    Returns:
+    graph (CUDAGraph): captured graph
+    static_outputs (): outputs which are overwritten in-place by each replay
+    """
+
+    # warm up on a side stream so that lazy initialization is not captured
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(num_warmup):
+            fn(static_inputs)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_outputs = fn(static_inputs)
+
+    return graph, static_outputs
+
+
+def _forward(input_bev_maps, model, configs):
+    """"
+    Perform inference and, for fpn_resnet, decode the model output, see _decode_outputs
+
+    Returns:
+    outputs (): raw darknet predictions in full precision, or the decoded fpn_resnet objects and keep mask
+                (None if there are no objects), see _decode_outputs
+    """
+
+    outputs = model(input_bev_maps)
+
+    # post-processing, nms and decoding are done in full precision
+    if 'darknet' in configs.arch:
+        return outputs.float()
+
+    if isinstance(outputs, tuple):
+        outputs = dict(zip(configs.heads, outputs))  # traced model returns heads as a tuple
+    outputs = {head: output.float() for head, output in outputs.items()}
+    return _decode_outputs(outputs, configs)
+
+
+def _replay_forward(input_bev_maps, model, configs):
+    """"
+    Run _forward by replaying a cuda graph, which is captured on the first call for each batch size,
+    only used for fpn_resnet as darknet copies its predictions to the host inside the forward pass
+    """
+
+    batch_size = input_bev_maps.shape[0]
+    if batch_size not in configs.cache.cuda_graphs:
+        static_input = input_bev_maps.clone()
+        configs.cache.cuda_graphs[batch_size] = (static_input,) + _capture_cuda_graph(
+            lambda x: _forward(x, model, configs), static_input)
+
+    static_input, graph, static_outputs = configs.cache.cuda_graphs[batch_size]
+    static_input.copy_(input_bev_maps)
+    graph.replay()
+
+    return static_outputs
+
+
+def _to_numpy(tensor, configs):
+    """"
+    Copy a tensor to the host, going through a cached pinned buffer on the gpu so that the device is synchronized once
+
+    Parameters:
+    tensor (tensor): tensor on configs.device
+    configs (edict): dictionary containing object and model-related parameters
+
+    Returns:
+    array (numpy array): host copy of the tensor, only valid until the next call with the same row shape
+    """
+
+    if configs.device.type != 'cuda':
+        return tensor.numpy()
+
+    # buffers are shared by all tensors with the same row shape and grow with the number of rows
+    num_rows, row_shape = tensor.shape[0], tuple(tensor.shape[1:])
+    pinned = configs.cache.pinned_buffers.get(row_shape)
+    if pinned is None or pinned.shape[0] < num_rows:
+        pinned = configs.cache.pinned_buffers[row_shape] = torch.empty((num_rows,) + row_shape,
+                                                                       dtype=tensor.dtype, pin_memory=True)
+    pinned[:num_rows].copy_(tensor, non_blocking=True)
+    torch.cuda.current_stream(configs.device).synchronize()
+
+    return pinned[:num_rows].numpy()
+
+
+def _bev_to_vehicle_space(detections, configs):
+    """"
+    Convert detections from BEV into vehicle space using the limits for x, y and z set in the configs structure
+
+    Parameters:
+    detections (2D numpy array or list): detected bounding boxes in BEV coordinates
+                                         [score, x, y, z, height, width, length, yaw]
+    configs (edict): dictionary containing object and model-related parameters
+
+    Returns:
+    objects (list): bounding boxes inside the detection range in vehicle space
+                    [id, x, y, z, height, width, length, yaw]
+    """
+
+    # check whether there are any detections
+    if len(detections) == 0:
+        return []
+
+    det = np.asarray(detections, dtype=np.float32).reshape(-1, 8)
+
+    # look up the configs values only once
+    sx, sy, half_y = configs.sx, configs.sy, configs.half_y
+    (x_min, x_max), (y_min, y_max), (z_min, z_max) = configs.lim_x, configs.lim_y, configs.lim_z
+
+    # convert all detections at once, writing into a preallocated array
+    objects = np.empty_like(det)
+    objects[:, 0] = 1
+    np.multiply(det[:, 2], sx, out=objects[:, 1])  # x
+    np.multiply(det[:, 1], sy, out=objects[:, 2])  # y
+    objects[:, 2] -= half_y
+    objects[:, 3:5] = det[:, 3:5]  # z, height
+    np.multiply(det[:, 5], sy, out=objects[:, 5])  # width
+    np.multiply(det[:, 6], sx, out=objects[:, 6])  # length
+    objects[:, 7] = det[:, 7]  # yaw
+
+    # keep only objects inside the detection range
+    img_x, img_y, z = objects[:, 1], objects[:, 2], objects[:, 3]
+    mask = ((x_min <= img_x) & (img_x <= x_max)
+            & (y_min <= img_y) & (img_y <= y_max)
+            & (z_min <= z) & (z <= z_max))
+
+    return objects[mask].tolist()
+
+
 def detect_objects(input_bev_maps, model, configs):
     """"
     Detect trained objects in birds-eye view and converts bounding boxes from BEV into vehicle space
 
     Parameters:
-    input_bev_maps (tensor): bird eye view map of point cloud to feed to the model
+    input_bev_maps (tensor or list): bird eye view map of point cloud to feed to the model, a tensor holding a batch
+                                     of such maps, or a list of such maps which are stacked and fed to the model in
+                                     batches of configs.batch_size
     model (): pytorch version of darknet or resnet
     configs (edict): dictionary containing object and model-related parameters
 
     Returns:
-    objects (list): detected bounding boxes in image coordinates [id, x, y, z, height, width, length, yaw]
+    objects (list): detected bounding boxes in image coordinates [id, x, y, z, height, width, length, yaw],
+                    or one such list per bev map if a batch or a list of bev maps has been passed
+
+    """
+
+    # update the scale factors if the bev limits have been changed since they were computed
+    if configs.bev_scales_key != _bev_scales_key(configs):
+        set_bev_scales(configs)
+
+    # process a single bev map or a batch of bev maps in one tensor directly
+    if not isinstance(input_bev_maps, (list, tuple)):
+        objects = _detect_batch(input_bev_maps, model, configs)
+        return objects[0] if input_bev_maps.shape[0] == 1 else objects
+
+    # pad the last batch with empty bev maps so that the model always sees the same input shape
+    objects = []
+    for start in range(0, len(input_bev_maps), configs.batch_size):
+        batch = torch.cat(input_bev_maps[start:start + configs.batch_size], dim=0).to(configs.device)
+        num_maps = batch.shape[0]
+        if num_maps < configs.batch_size:
+            batch = torch.cat([batch, batch.new_zeros((configs.batch_size - num_maps,) + batch.shape[1:])], dim=0)
+        objects += _detect_batch(batch, model, configs)[:num_maps]
+
+    return objects
+
 
+def _detect_batch(input_bev_maps, model, configs):
+    """"
+    Detect trained objects in a batch of bev maps, see detect_objects
+
+    Returns:
+    objects (list): one list of detected bounding boxes in image coordinates per bev map in the batch
     """
 
     ##################
     # Decode model output and perform post-processing
     ##################
 
+    # convert input into channels-last memory layout
+    input_bev_maps = input_bev_maps.contiguous(memory_format=torch.channels_last)
+
     # deactivate autograd engine during test to reduce memory usage and speed up computations
-    with torch.no_grad():
+    # and run the forward pass in bfloat16 when on the gpu
+    with torch.inference_mode(), _autocast(configs):
 
-        # perform inference
-        outputs = model(input_bev_maps)
+        # perform inference, replayed from a cuda graph together with decoding when on the gpu, darknet is run
+        # eagerly because its forward pass ends with a blocking copy of the predictions to the host
+        if configs.device.type == 'cuda' and configs.use_cuda_graphs and 'fpn_resnet' in configs.arch:
+            outputs = _replay_forward(input_bev_maps, model, configs)
+        else:
+            outputs = _forward(input_bev_maps, model, configs)
 
         # decode model output into target object format
         if 'darknet' in configs.arch:
 
             # perform post-processing
-            output_post = post_processing_v2(outputs, conf_thresh=configs.conf_thresh, nms_thresh=configs.nms_thresh)
+            output_post = configs.post_processing(outputs, conf_thresh=configs.conf_thresh,
+                                                  nms_thresh=configs.nms_thresh)
             detections = []
-            for sample_i in range(len(output_post)):
-                if output_post[sample_i] is None:
+            for detection in output_post:
+                if detection is None:
+                    detections.append([])
                     continue
-                detection = output_post[sample_i]
-                for obj in detection:
-                    x, y, w, l, im, re, _, _, _ = obj
-                    yaw = np.arctan2(im, re)
-                    detections.append([1, x, y, 0.0, 1.50, w, l, yaw])
+                # (x, y, w, l, im, re, object_conf, class_score, class_pred) for all objects of the sample
+                detection = detection.cpu().numpy()
+                sample_detections = np.empty((len(detection), 8), dtype=np.float32)
+                sample_detections[:, 0] = 1
+                sample_detections[:, 1:3] = detection[:, 0:2]  # x, y
+                sample_detections[:, 3] = 0.0  # z
+                sample_detections[:, 4] = 1.50  # height
+                sample_detections[:, 5:7] = detection[:, 2:4]  # width, length
+                np.arctan2(detection[:, 4], detection[:, 5], out=sample_detections[:, 7])  # yaw
+                detections.append(sample_detections)
 
         elif 'fpn_resnet' in configs.arch:
-            # decode output and perform post-processing
+            if outputs is None:
+                return [[] for _ in range(input_bev_maps.shape[0])]
 
-            outputs['hm_cen'] = _sigmoid(outputs['hm_cen'])
-            outputs['cen_offset'] = _sigmoid(outputs['cen_offset'])
-            detections = decode(outputs['hm_cen'], outputs['cen_offset'],
-                                outputs['direction'], outputs['z_coor'], outputs['dim'], K=configs.k)
-            detections = detections.cpu().numpy().astype(np.float32)
-            detections = post_processing(detections, configs)
-            detections = detections[0][1]
+            # only the objects which are kept are copied to the host
+            objects, keep = outputs
+            assert objects.dtype == torch.float32, 'Decoded objects must be float32, got {}'.format(objects.dtype)
+            objects = _to_numpy(objects[keep], configs)
+            sample_idx = objects[:, 0].astype(np.int64)
+            return [objects[sample_idx == i, 1:].tolist() for i in range(input_bev_maps.shape[0])]
 
     # Extract 3d bounding boxes from model response
-    objects = []
-
-    # check whether there are any detections
-    if len(detections) > 0:
-        # loop over all detections
-        for obj in detections:
-            # convert from BEV into vehicle space using the limits for x, y and z set in the configs structure
-            _, bev_x, bev_y, z, bbox_bev_height, bbox_bev_width, bbox_bev_length, yaw = obj
-
-            img_x = bev_y / configs.bev_height * (configs.lim_x[1] - configs.lim_x[0])
-            img_y = bev_x / configs.bev_width * (configs.lim_y[1] - configs.lim_y[0]) - (
-                    configs.lim_y[1] - configs.lim_y[0]) / 2.0
-            bbox_img_width = bbox_bev_width / configs.bev_width * (configs.lim_y[1] - configs.lim_y[0])
-            bbox_img_length = bbox_bev_length / configs.bev_height * (configs.lim_x[1] - configs.lim_x[0])
-            if (configs.lim_x[0] <= img_x <= configs.lim_x[1]
-                    and configs.lim_y[0] <= img_y <= configs.lim_y[1]
-                    and configs.lim_z[0] <= z <= configs.lim_z[1]):
-                # append the current object to the 'objects' array
-                objects.append([1, img_x, img_y, z, bbox_bev_height, bbox_img_width, bbox_img_length, yaw])
+    objects = [_bev_to_vehicle_space(sample_detections, configs) for sample_detections in detections]
 
     return objects
@@ -12,7 +12,8 @@
 import torch
 import torch.distributed as dist
 
-__all__ = ['convert2cpu', 'convert2cpu_long', 'to_cpu', 'reduce_tensor', 'to_python_float', '_sigmoid']
+__all__ = ['convert2cpu', 'convert2cpu_long', 'to_cpu', 'reduce_tensor', 'to_python_float', '_sigmoid',
+           '_fused_sigmoid']
 
 
 def convert2cpu(gpu_matrix):
@@ -43,3 +44,10 @@ def to_python_float(t):
 
 def _sigmoid(x):
     return torch.clamp(x.sigmoid_(), min=1e-4, max=1 - 1e-4)
+
+
+@torch.jit.script
+def _fused_sigmoid(hm_cen, cen_offset):
+    # same as _sigmoid on both heads, scripted so that the elementwise ops can be fused into a single kernel
+    return torch.clamp(hm_cen.sigmoid(), min=1e-4, max=1 - 1e-4), \
+           torch.clamp(cen_offset.sigmoid(), min=1e-4, max=1 - 1e-4)